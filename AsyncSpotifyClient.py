@@ -0,0 +1,233 @@
+"""
+AsyncSpotifyClient Module
+
+This module provides an asyncio-based client used by the Flask server for high fan-out Spotify API operations,
+such as paging through playlists and tracks, inserting songs into the queue and fetching playlist cover images.
+"""
+import asyncio
+import requests
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+
+
+class AsyncSpotifyClient:
+    """
+    A class that runs many Spotify API requests concurrently on one long-lived asyncio event loop.
+    Every request made through the client, from any thread, shares one semaphore and one worker pool,
+    so at most max_concurrency requests (16 by default) are in flight across the whole process.
+    The requests themselves are blocking calls made on the worker threads, so concurrency is capped by the pool size
+    rather than by the event loop. Each worker thread keeps its own requests.Session, so connections are reused.
+    """
+    def __init__(self, max_concurrency=16, request_timeout=10):
+        """
+        Initializes the AsyncSpotifyClient instance. The event loop is started on first use.
+
+        Args:
+            max_concurrency (int): The maximum number of requests that can be in flight at the same time.
+            request_timeout (int): The number of seconds to wait for the server before a request fails.
+        """
+        self.max_concurrency = max_concurrency
+        self.request_timeout = request_timeout
+        self.loop = None
+        self.loop_lock = threading.Lock()
+        self.semaphore = None
+        self.executor = None
+        self.thread_sessions = threading.local()
+
+    def start(self):
+        """
+        Starts the event loop on a background thread, along with the shared semaphore and worker pool, if it is not running yet.
+
+        Returns:
+            asyncio.AbstractEventLoop: The running event loop.
+        """
+        with self.loop_lock:
+            if self.loop is None:
+                self.executor = ThreadPoolExecutor(max_workers=self.max_concurrency, thread_name_prefix="spotify-client")
+                self.semaphore = asyncio.Semaphore(self.max_concurrency)
+                self.loop = asyncio.new_event_loop()
+                loop_thread = threading.Thread(target=self.loop.run_forever, name="spotify-client-loop")
+                loop_thread.daemon = True
+                loop_thread.start()
+            return self.loop
+
+    def run(self, coroutine):
+        """
+        Runs a coroutine on the client's event loop and waits for its result, allowing the synchronous Flask routes and the GUI to use the client.
+        Must not be called from the event loop itself.
+
+        Args:
+            coroutine (coroutine): The coroutine to run.
+
+        Returns:
+            object: The result of the coroutine.
+        """
+        return asyncio.run_coroutine_threadsafe(coroutine, self.start()).result()
+
+    def send_request(self, method, url, **kwargs):
+        """
+        Sends a single blocking request through the requests.Session of the current worker thread,
+        creating the session on the thread's first request.
+
+        Args:
+            method (str): The HTTP method of the request.
+            url (str): The URL of the request.
+            **kwargs: Additional arguments passed to requests.Session.request.
+
+        Returns:
+            requests.Response: The response of the request.
+        """
+        if not hasattr(self.thread_sessions, "session"):
+            self.thread_sessions.session = requests.Session()
+        return self.thread_sessions.session.request(method, url, **kwargs)
+
+    async def request(self, method, url, **kwargs):
+        """
+        Sends a single request on the worker pool once a slot in the shared semaphore is free.
+
+        Args:
+            method (str): The HTTP method of the request.
+            url (str): The URL of the request.
+            **kwargs: Additional arguments passed to requests.Session.request.
+
+        Returns:
+            requests.Response: The response of the request.
+        """
+        kwargs.setdefault("timeout", self.request_timeout)
+        async with self.semaphore:
+            return await asyncio.get_running_loop().run_in_executor(
+                self.executor, partial(self.send_request, method, url, **kwargs))
+
+    async def conditional_get(self, url, cache, headers=None, params=None):
+        """
+        Sends a GET request that revalidates a cached response with its ETag and Last-Modified validators.
+        If the server answers 304 Not Modified, the cached response is returned instead of downloading it again.
+
+        Args:
+            url (str): The URL of the request.
+            cache (dict): The cache of responses, keyed by URL and query parameters. Responses with validators are stored in it.
+            headers (dict, optional): The headers sent with the request.
+            params (dict, optional): The query parameters of the request.
+
+        Returns:
+            requests.Response: The response of the request, or the cached response if it has not changed.
+        """
+        cache_key = (url, tuple(sorted((params or {}).items())))
+        cached_response = cache.get(cache_key)
+        headers = dict(headers or {})
+        if cached_response is not None:
+            if "ETag" in cached_response.headers:
+                headers["If-None-Match"] = cached_response.headers["ETag"]
+            if "Last-Modified" in cached_response.headers:
+                headers["If-Modified-Since"] = cached_response.headers["Last-Modified"]
+
+        response = await self.request("GET", url, headers=headers, params=params)
+        if response.status_code == 304 and cached_response is not None:
+            return cached_response
+        if response.status_code == 200 and ("ETag" in response.headers or "Last-Modified" in response.headers):
+            cache[cache_key] = response
+        return response
+
+    async def get(self, url, cache=None, headers=None, params=None):
+        """
+        Sends a GET request, revalidating it against the cache if one is given.
+
+        Args:
+            url (str): The URL of the request.
+            cache (dict, optional): The cache of responses used for conditional requests.
+            headers (dict, optional): The headers sent with the request.
+            params (dict, optional): The query parameters of the request.
+
+        Returns:
+            requests.Response: The response of the request.
+        """
+        if cache is None:
+            return await self.request("GET", url, headers=headers, params=params)
+        return await self.conditional_get(url, cache, headers=headers, params=params)
+
+    async def get_all_pages(self, url, headers, limit, cache=None):
+        """
+        Retrieves every page of a paged Spotify endpoint. The first page is used to find the total, then the remaining
+        pages are requested concurrently.
+
+        Args:
+            url (str): The URL of the paged endpoint.
+            headers (dict): The headers sent with each request.
+            limit (int): The number of items requested per page.
+            cache (dict, optional): The cache of responses used to revalidate each page with a conditional request.
+
+        Returns:
+            tuple: The list of items in page order and None on success, or None and the failed response.
+        """
+        response = await self.get(url, cache, headers=headers, params={"limit": limit, "offset": 0})
+        if response.status_code != 200:
+            return None, response
+
+        first_page = response.json()
+        all_items = first_page.get("items", [])
+        total = first_page.get("total", len(all_items))
+
+        responses = await asyncio.gather(*[
+            self.get(url, cache, headers=headers, params={"limit": limit, "offset": offset})
+            for offset in range(limit, total, limit)
+        ])
+        for response in responses:
+            if response.status_code != 200:
+                return None, response
+            all_items.extend(response.json().get("items", []))
+        return all_items, None
+
+    async def get_many_pages(self, requests_by_key, limit):
+        """
+        Retrieves every page of several paged endpoints at once, such as the tracks of many playlists.
+
+        Args:
+            requests_by_key (dict): A mapping of keys to (url, headers) tuples.
+            limit (int): The number of items requested per page.
+
+        Returns:
+            dict: A mapping of each key to its (items, failed_response) tuple.
+        """
+        keys = list(requests_by_key)
+        results = await asyncio.gather(*[
+            self.get_all_pages(url, headers, limit) for url, headers in requests_by_key.values()
+        ])
+        return dict(zip(keys, results))
+
+    async def post_many(self, url, headers, params_list, ordered=False):
+        """
+        Sends a POST request for each set of parameters concurrently, such as adding several songs to the queue.
+
+        Args:
+            url (str): The URL of the endpoint.
+            headers (dict): The headers sent with each request.
+            params_list (list): A list of query parameter dicts, one per request.
+            ordered (bool): Whether the requests must reach the server in order, in which case they are sent one at a time.
+
+        Returns:
+            list: The responses in the same order as params_list.
+        """
+        if ordered:
+            return [await self.request("POST", url, headers=headers, params=params) for params in params_list]
+        return await asyncio.gather(*[
+            self.request("POST", url, headers=headers, params=params) for params in params_list
+        ])
+
+    async def get_many_contents(self, urls, cache=None):
+        """
+        Downloads the raw content of several URLs concurrently, such as playlist cover images.
+
+        Args:
+            urls (dict): A mapping of keys to URLs.
+            cache (dict, optional): The cache of responses used to revalidate each URL with a conditional request.
+
+        Returns:
+            dict: A mapping of each key to the downloaded bytes, or to the exception raised while downloading.
+        """
+        keys = list(urls)
+        responses = await asyncio.gather(*[
+            self.get(url, cache) for url in urls.values()
+        ], return_exceptions=True)
+        return {key: response if isinstance(response, Exception) else response.content
+                for key, response in zip(keys, responses)}
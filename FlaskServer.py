@@ -3,18 +3,36 @@ FlaskServer Module
 
 This Flask server module integrates with the Spotify API, allowing users to authenticate with Spotify, manage playback, and interact with their playlists.
 """
-from flask import Flask, request, redirect, url_for, jsonify, render_template_string
+from flask import Flask, request, redirect, url_for, jsonify, render_template_string, g
+from functools import wraps
 from random import random
 import requests
 import os
 import random
+import secrets
+import threading
 import time
+from array import array
+from concurrent.futures import Future
+from datetime import datetime, timezone
+from AsyncSpotifyClient import AsyncSpotifyClient
+from PooledWSGIServer import PooledWSGIServer
 
 # Spotify API credentials
 client_id = None
 client_secret = None
 config_file_path = "config.conf"
-REDIRECT_URI = "http://localhost:5000/callback"
+
+# Server settings, each of which can be overridden with an environment variable
+SERVER_MODE = os.environ.get("TRUE_SHUFFLE_SERVER_MODE", "pooled")
+SERVER_HOST = os.environ.get("TRUE_SHUFFLE_HOST", "127.0.0.1")
+SERVER_PORT = int(os.environ.get("TRUE_SHUFFLE_PORT", 5000))
+SERVER_WORKERS = int(os.environ.get("TRUE_SHUFFLE_WORKERS", 8))
+SERVER_REQUEST_QUEUE_SIZE = int(os.environ.get("TRUE_SHUFFLE_REQUEST_QUEUE_SIZE", 64))
+SERVER_READ_TIMEOUT = int(os.environ.get("TRUE_SHUFFLE_READ_TIMEOUT", 5))
+SERVER_DRAIN_TIMEOUT = int(os.environ.get("TRUE_SHUFFLE_DRAIN_TIMEOUT", 10))
+SERVER_PUBLIC_URL = os.environ.get("TRUE_SHUFFLE_PUBLIC_URL", f"http://localhost:{SERVER_PORT}")
+REDIRECT_URI = os.environ.get("TRUE_SHUFFLE_REDIRECT_URI", f"{SERVER_PUBLIC_URL}/callback")
 SCOPE = ("user-read-private user-read-email "
          "user-modify-playback-state  "
          "user-read-currently-playing "
@@ -22,7 +40,32 @@ SCOPE = ("user-read-private user-read-email "
          "playlist-read-private "
          "playlist-read-collaborative")
 
-user_tokens = {}
+user_sessions = {}
+login_states = {}
+user_sessions_lock = threading.Lock()
+last_session_cleanup = 0
+SESSION_HEADER = "X-Session-Id"
+LOGIN_STATE_COOKIE = "login_state"
+SESSION_IDLE_TIMEOUT = 7 * 24 * 60 * 60
+LOGIN_TIMEOUT = 10 * 60
+SESSION_CLEANUP_INTERVAL = 60
+RATE_LIMIT_CAPACITY = 60
+RATE_LIMIT_REFILL_PER_SECOND = 1
+PREFETCH_RATE_LIMIT_CAPACITY = 10
+PREFETCH_RATE_LIMIT_REFILL_PER_SECOND = 0.2
+RATE_LIMIT_BUDGETS = {
+    "requests": (RATE_LIMIT_CAPACITY, RATE_LIMIT_REFILL_PER_SECOND),
+    "prefetches": (PREFETCH_RATE_LIMIT_CAPACITY, PREFETCH_RATE_LIMIT_REFILL_PER_SECOND)
+}
+RECENTLY_ADDED_DAYS = 30
+MIN_TRACK_WEIGHT = 0.1
+REQUEST_TIMEOUT = 10
+spotify_client = AsyncSpotifyClient(max_concurrency=16, request_timeout=REQUEST_TIMEOUT)
+single_flight_calls = {}
+micro_cache = {}
+single_flight_lock = threading.Lock()
+MICRO_CACHE_TTL = 1
+MICRO_CACHE_MAX_ENTRIES = 256
 
 # Spotify API endpoints
 API_BASE_URL = "https://api.spotify.com/v1"
@@ -31,10 +74,13 @@ TOKEN_URL = "https://accounts.spotify.com/api/token"
 QUEUE_URL = f"{API_BASE_URL}/me/player/queue"
 SKIP_SONG_URL = f"{API_BASE_URL}/me/player/next"
 PAUSE_PLAYBACK_URL = f"{API_BASE_URL}/me/player/pause"
-PLAYLISTS_URL = f"{API_BASE_URL}/me/playlists?fields=items(id, name, images)"
+PLAYLISTS_URL = f"{API_BASE_URL}/me/playlists?fields=total,items(id, name, images, snapshot_id)"
+PLAYLIST_URL = f"{API_BASE_URL}/playlists/{{playlist_id}}"
 PLAYLIST_TRACKS_URL = f"{API_BASE_URL}/playlists/{{playlist_id}}/tracks"
 CURRENTLY_PLAYING_TRACK = f"{API_BASE_URL}/me/player/currently-playing"
 GET_PLAYBACK_STATE_URL = f"{API_BASE_URL}/me/player"
+PLAYLISTS_PAGE_LIMIT = 50
+PLAYLIST_TRACKS_PAGE_LIMIT = 100
 
 
 def update_api_credentials(get_client_id, get_client_secret):
@@ -52,20 +98,43 @@ def update_api_credentials(get_client_id, get_client_secret):
 
 
 app = Flask(__name__)
+server = None
 
 
 def run_flask():
     """
-    Starts the Flask application.
+    Starts the Flask application. In the default "pooled" mode it is served by a PooledWSGIServer,
+    and in "development" mode by Flask's development server.
     """
+    global server
     app.secret_key = os.urandom(24)
-    app.run(debug=False)
+    if SERVER_MODE == "development":
+        app.run(host=SERVER_HOST, port=SERVER_PORT, debug=False)
+        return
+    server = PooledWSGIServer(SERVER_HOST, SERVER_PORT, app,
+                              workers=SERVER_WORKERS,
+                              request_queue_size=SERVER_REQUEST_QUEUE_SIZE,
+                              read_timeout=SERVER_READ_TIMEOUT)
+    server.serve_forever()
 
 
-def get_auth_url():
+def stop_flask():
+    """
+    Stops the Flask application, letting in-flight requests finish first. Does nothing in "development" mode.
+    """
+    global server
+    if server is not None:
+        server.shutdown_gracefully(drain_timeout=SERVER_DRAIN_TIMEOUT)
+        server = None
+
+
+def get_auth_url(state):
     """
     Generates the Spotify authorization URL.
 
+    Args:
+        state (str): The one-time login state, passed through Spotify and checked in the callback.
+
     Returns:
         str: The URL for Spotify authorization.
     """
@@ -73,7 +142,8 @@ def get_auth_url():
         "response_type": "code",
         "redirect_uri": REDIRECT_URI,
         "scope": SCOPE,
-        "client_id": client_id
+        "client_id": client_id,
+        "state": state
     }
     return f"{AUTH_URL}?" + "&".join([f"{key}={val}" for key, val in auth_query_params.items()])
 
@@ -96,7 +166,7 @@ def get_access_token(code):
         "client_id": client_id,
         "client_secret": client_secret,
     }
-    response = requests.post(TOKEN_URL, data=token_data)
+    response = requests.post(TOKEN_URL, data=token_data, timeout=REQUEST_TIMEOUT)
     return response.json()
 
 
@@ -116,46 +186,328 @@ def refresh_access_token(refresh_token):
         "client_id": client_id,
         "client_secret": client_secret,
     }
-    response = requests.post(TOKEN_URL, data=token_data)
+    response = requests.post(TOKEN_URL, data=token_data, timeout=REQUEST_TIMEOUT)
     return response.json()
 
 
-def get_valid_token():
+def create_user_session():
+    """
+    Creates a new, not yet authenticated session under a random session ID generated by the server.
+
+    Returns:
+        str: The session ID of the new session.
+    """
+    with user_sessions_lock:
+        session_id = secrets.token_urlsafe(32)
+        while session_id in user_sessions:
+            session_id = secrets.token_urlsafe(32)
+        user_sessions[session_id] = {
+            "access_token": None,
+            "refresh_token": None,
+            "expires_at": 0,
+            "last_seen": time.time(),
+            "lock": threading.Lock(),
+            "rate_limit_lock": threading.Lock(),
+            "rate_limits": {budget: {"tokens": capacity, "updated_at": time.time()}
+                            for budget, (capacity, _) in RATE_LIMIT_BUDGETS.items()},
+            "playlist_snapshots": {},
+            "playlist_tracks_cache": {},
+            "response_cache": {},
+            "queued_counts": {},
+            "queued_counts_lock": threading.Lock()
+        }
+    return session_id
+
+
+def store_user_tokens(user_session, access_token, refresh_token, expires_in):
+    """
+    Stores the tokens of a user who has just authenticated in their session.
+
+    Args:
+        user_session (dict): The session that started the login.
+        access_token (str): The access token of the user.
+        refresh_token (str): The refresh token of the user.
+        expires_in (int): The number of seconds until the access token expires.
+    """
+    with user_session["lock"]:
+        user_session["access_token"] = access_token
+        user_session["refresh_token"] = refresh_token
+        user_session["expires_at"] = time.time() + expires_in
+
+
+def create_login_state(session_id):
+    """
+    Creates a random one-time login state for a session, which expires after the login timeout.
+
+    Args:
+        session_id (str): The session ID of the user logging in.
+
+    Returns:
+        str: The login state.
+    """
+    state = secrets.token_urlsafe(32)
+    with user_sessions_lock:
+        login_states[state] = {"session_id": session_id, "expires_at": time.time() + LOGIN_TIMEOUT}
+    return state
+
+
+def consume_login_state(state):
+    """
+    Removes a login state so that it cannot be used again, and returns the session that created it.
+
+    Args:
+        state (str): The login state returned by Spotify.
+
+    Returns:
+        dict: The session that started the login, or None if the state is unknown, already used or expired.
+    """
+    with user_sessions_lock:
+        login_state = login_states.pop(state, None)
+        if login_state is None or login_state["expires_at"] < time.time():
+            return None
+        return user_sessions.get(login_state["session_id"])
+
+
+def cleanup_expired_sessions():
+    """
+    Removes the sessions of users who have not made a request within the idle timeout, sessions that were never authenticated
+    within the login timeout, and expired login states. Runs at most once per cleanup interval.
+    """
+    global last_session_cleanup
+    now = time.time()
+    with user_sessions_lock:
+        if now - last_session_cleanup < SESSION_CLEANUP_INTERVAL:
+            return
+        last_session_cleanup = now
+        for session_id in [session_id for session_id, user_session in user_sessions.items()
+                           if now - user_session["last_seen"] >
+                           (SESSION_IDLE_TIMEOUT if user_session["access_token"] else LOGIN_TIMEOUT)]:
+            del user_sessions[session_id]
+        for state in [state for state, login_state in login_states.items() if login_state["expires_at"] < now]:
+            del login_states[state]
+
+
+def get_user_session(session_id):
+    """
+    Retrieves the session of a user and marks it as active.
+
+    Args:
+        session_id (str): The session ID of the user.
+
+    Returns:
+        dict: The session of the user, or None if there is no such session.
+    """
+    cleanup_expired_sessions()
+    with user_sessions_lock:
+        user_session = user_sessions.get(session_id)
+        if user_session is not None:
+            user_session["last_seen"] = time.time()
+        return user_session
+
+
+def consume_rate_limit(user_session, cost=1, budget="requests"):
+    """
+    Takes requests from one of the user's rate limit budgets, which refills at a fixed rate up to its capacity.
+    Prefetches and playlist warming have their own "prefetches" budget so that they cannot use up the budget of the user's other requests.
+
+    Args:
+        user_session (dict): The session of the user.
+        cost (int): The number of requests to take from the budget.
+        budget (str): The budget to take from, either "requests" or "prefetches".
+
+    Returns:
+        bool: True if the budget allowed the requests, False otherwise.
     """
-    Retrieves a valid access token. Refreshes the token if expired.
+    capacity, refill_per_second = RATE_LIMIT_BUDGETS[budget]
+    with user_session["rate_limit_lock"]:
+        rate_limit = user_session["rate_limits"][budget]
+        now = time.time()
+        elapsed = now - rate_limit["updated_at"]
+        rate_limit["tokens"] = min(capacity, rate_limit["tokens"] + elapsed * refill_per_second)
+        rate_limit["updated_at"] = now
+        if rate_limit["tokens"] < cost:
+            return False
+        rate_limit["tokens"] -= cost
+        return True
+
+
+def get_valid_token(user_session):
+    """
+    Retrieves a valid access token for a user. Refreshes the token if expired.
+
+    Args:
+        user_session (dict): The session of the user.
 
     Returns:
         str: The access token.
     """
-    access_token_info = next(iter(user_tokens.values()))
-    if time.time() > access_token_info["expires_at"]:
-        response = refresh_access_token(access_token_info["refresh_token"])
-        new_access_token = response.get("access_token")
-        expires_in = response.get("expires_in")
+    with user_session["lock"]:
+        if time.time() > user_session["expires_at"]:
+            response = refresh_access_token(user_session["refresh_token"])
+            new_access_token = response.get("access_token")
+            expires_in = response.get("expires_in")
 
-        access_token_info["access_token"] = new_access_token
-        access_token_info["expires_at"] = time.time() + expires_in
+            user_session["access_token"] = new_access_token
+            user_session["expires_at"] = time.time() + expires_in
+            if response.get("refresh_token"):
+                user_session["refresh_token"] = response["refresh_token"]
 
-    return access_token_info["access_token"]
+        return user_session["access_token"]
 
 
-def clear_user_token():
+def clear_user_token(session_id=None):
     """
-    Clears all stored user tokens.
+    Clears the stored tokens of a user, or of every user if no session ID is given.
+
+    Args:
+        session_id (str, optional): The session ID of the user.
     """
-    global user_tokens
-    user_tokens.clear()
+    with user_sessions_lock:
+        if session_id is None:
+            user_sessions.clear()
+        else:
+            user_sessions.pop(session_id, None)
+
+
+def single_flight(key, function):
+    """
+    Calls a function once for all concurrent callers with the same key, and shares its result or exception with all of them.
+
+    Args:
+        key (tuple): The key identifying identical calls.
+        function (function): The function to call.
+
+    Returns:
+        object: The result of the function.
+    """
+    with single_flight_lock:
+        call = single_flight_calls.get(key)
+        is_caller = call is None
+        if is_caller:
+            call = Future()
+            single_flight_calls[key] = call
+    if not is_caller:
+        return call.result()
+
+    try:
+        result = function()
+        call.set_result(result)
+        return result
+    except Exception as e:
+        call.set_exception(e)
+        raise
+    finally:
+        with single_flight_lock:
+            single_flight_calls.pop(key, None)
+
+
+def coalesced_get(url, headers, params=None, micro_cache_ttl=0):
+    """
+    Sends a GET request to Spotify, sharing one upstream request between identical concurrent GETs.
+    Successful responses of volatile endpoints, such as the playback queue, can also be reused for a short time.
+
+    Args:
+        url (str): The URL of the request.
+        headers (dict): The headers sent with the request, including the user's authorization.
+        params (dict, optional): The query parameters of the request.
+        micro_cache_ttl (float): The number of seconds a successful response is reused for, or 0 to not reuse it.
+
+    Returns:
+        requests.Response: The response of the request.
+    """
+    key = (url, headers.get("Authorization"), tuple(sorted((params or {}).items())))
+    if micro_cache_ttl:
+        with single_flight_lock:
+            cached_response = micro_cache.get(key)
+        if cached_response is not None and cached_response[0] > time.time():
+            return cached_response[1]
+
+    response = single_flight(key, lambda: requests.get(url, headers=headers, params=params, timeout=REQUEST_TIMEOUT))
+
+    if micro_cache_ttl and response.status_code in (200, 204):
+        now = time.time()
+        with single_flight_lock:
+            micro_cache.pop(key, None)
+            if len(micro_cache) >= MICRO_CACHE_MAX_ENTRIES:
+                for expired_key in [cache_key for cache_key, (expires_at, _) in micro_cache.items() if expires_at <= now]:
+                    del micro_cache[expired_key]
+            # Entries are kept in insertion order, so the oldest ones are evicted first when none have expired
+            while len(micro_cache) >= MICRO_CACHE_MAX_ENTRIES:
+                del micro_cache[next(iter(micro_cache))]
+            micro_cache[key] = (now + micro_cache_ttl, response)
+    return response
+
+
+def user_session_required(route=None, budget="requests"):
+    """
+    Decorates a route so that it runs only for an authenticated user with rate limit budget left.
+    The user is identified by the session ID header, and their session is made available as flask.g.user_session.
+    Can be used directly, or called with a budget such as @user_session_required(budget="prefetches").
+
+    Args:
+        route (function): The route function to decorate.
+        budget (str): The rate limit budget each call is taken from.
+
+    Returns:
+        function: The decorated route function.
+    """
+    if route is None:
+        return lambda route: user_session_required(route, budget)
+
+    @wraps(route)
+    def wrapper(*args, **kwargs):
+        user_session = get_user_session(request.headers.get(SESSION_HEADER))
+        if user_session is None or user_session["access_token"] is None:
+            return "Not authenticated.", 401
+        if not consume_rate_limit(user_session, budget=budget):
+            return "Rate limit exceeded, try again later.", 429
+        g.user_session = user_session
+        return route(*args, **kwargs)
+    return wrapper
+
+
+@app.route('/create_session', methods=["POST"])
+def create_session():
+    """
+    Creates a new session for a client, which must then log in to Spotify through /start_login.
+
+    Returns:
+        flask.Response: A JSON response containing the session ID generated by the server.
+    """
+    return jsonify({"session_id": create_user_session()})
+
+
+@app.route('/start_login', methods=["POST"])
+def start_login():
+    """
+    Starts logging in the session identified by the session ID header by creating a one-time login state.
+
+    Returns:
+        flask.Response: A JSON response containing the URL to open in the browser, or an error message if there is no such session.
+    """
+    session_id = request.headers.get(SESSION_HEADER)
+    if get_user_session(session_id) is None:
+        return "Unknown session.", 401
+    # The login page must be on the same host as the redirect URI, so the login state cookie is sent with the callback
+    return jsonify({"login_url": f"{SERVER_PUBLIC_URL}/?state={create_login_state(session_id)}"})
 
 
 @app.route('/')
 def home():
     """
-    Redirects to the Spotify authorization URL.
+    Redirects to the Spotify authorization URL for the login state given in the query string.
+    The state is also stored in a cookie so that the callback only accepts it from the same browser.
 
     Returns:
-        flask.Response: A redirect response to the authorization URL.
+        flask.Response: A redirect response to the authorization URL, or an error message if the state is unknown.
     """
-    return redirect(get_auth_url())
+    state = request.args.get("state")
+    with user_sessions_lock:
+        if state not in login_states:
+            return "Unknown or expired login, start the login again from the application.", 400
+    response = redirect(get_auth_url(state))
+    response.set_cookie(LOGIN_STATE_COOKIE, state, max_age=LOGIN_TIMEOUT, httponly=True, samesite="Lax")
+    return response
 
 
 @app.route('/callback')
@@ -168,8 +520,13 @@ def callback():
     """
     code = request.args.get("code")
     error = request.args.get("error")
+    state = request.args.get("state")
+
+    if not state or state != request.cookies.get(LOGIN_STATE_COOKIE):
+        return redirect(url_for("failed_webpage"))
+    user_session = consume_login_state(state)
 
-    if error:
+    if error or user_session is None:
         return redirect(url_for("failed_webpage"))
 
     response = get_access_token(code)
@@ -181,12 +538,10 @@ def callback():
     refresh_token = response.get("refresh_token")
     expires_in = response.get("expires_in")
 
-    user_tokens[access_token] = {
-        "access_token": access_token,
-        "refresh_token": refresh_token,
-        "expires_at": time.time() + expires_in
-    }
-    return redirect(url_for("success_webpage"))
+    store_user_tokens(user_session, access_token, refresh_token, expires_in)
+    response = redirect(url_for("success_webpage"))
+    response.delete_cookie(LOGIN_STATE_COOKIE)
+    return response
 
 
 @app.route('/success_webpage')
@@ -214,34 +569,40 @@ def failed_webpage():
 @app.route('/check_authentication')
 def check_authentication():
     """
-    Checks if the user is authenticated.
+    Checks if the user identified by the session ID header is authenticated.
 
     Returns:
         flask.Response: A JSON response indicating whether authentication was successful.
     """
-    if user_tokens:
+    user_session = get_user_session(request.headers.get(SESSION_HEADER))
+    if user_session is not None and user_session["access_token"] is not None:
         return jsonify({"success": True})
     else:
         return jsonify({"success": False})
 
 
 @app.route('/playlists')
+@user_session_required
 def playlists():
     """
-    Retrieves and returns the user's Spotify playlists.
+    Retrieves and returns the user's Spotify playlists. Concurrent refreshes by the same user share one fetch.
 
     Returns:
         flask.Response: A JSON response containing the user's playlists or an error message.
     """
-    access_token = get_valid_token()
+    access_token = get_valid_token(g.user_session)
 
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(PLAYLISTS_URL, headers=headers)
+    response_cache = g.user_session["response_cache"]
+    playlists, failed_response = single_flight(
+        ("playlists", access_token),
+        lambda: spotify_client.run(spotify_client.get_all_pages(PLAYLISTS_URL, headers, PLAYLISTS_PAGE_LIMIT,
+                                                                cache=response_cache)))
 
-    if response.status_code == 200:
-        playlists = response.json().get("items", [])
+    if failed_response is None:
         formatted_playlists = []
         for playlist in playlists:
+            g.user_session["playlist_snapshots"][playlist["id"]] = playlist.get("snapshot_id")
             formatted_playlists.append({
                 "id": playlist["id"],
                 "name": playlist["name"],
@@ -249,10 +610,11 @@ def playlists():
             })
         return jsonify(formatted_playlists)
     else:
-        return "Failed to fetch playlists.", response.status_code
+        return "Failed to fetch playlists.", failed_response.status_code
 
 
 @app.route('/get_queue')
+@user_session_required
 def get_queue():
     """
     Retrieves and returns the current playback queue.
@@ -260,9 +622,9 @@ def get_queue():
     Returns:
         flask.Response: A JSON response containing the current playback queue or an error message.
     """
-    access_token = get_valid_token()
+    access_token = get_valid_token(g.user_session)
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.get(QUEUE_URL, headers=headers)
+    response = coalesced_get(QUEUE_URL, headers, micro_cache_ttl=MICRO_CACHE_TTL)
 
     if response.status_code == 200:
         queue_data = response.json().get("queue", [])
@@ -276,7 +638,404 @@ def get_queue():
         return "Failed to fetch queue.", response.status_code
 
 
+def get_cached_tracks(user_session, playlist_id):
+    """
+    Retrieves the cached tracks of a playlist if they match the playlist's latest known snapshot.
+
+    Args:
+        user_session (dict): The session of the user whose cache is used.
+        playlist_id (str): The ID of the playlist.
+
+    Returns:
+        dict: The cached track columns, or None if the playlist is not cached or the cache is stale.
+    """
+    snapshot_id = user_session["playlist_snapshots"].get(playlist_id)
+    cached_tracks = user_session["playlist_tracks_cache"].get(playlist_id)
+    if snapshot_id is None or cached_tracks is None or cached_tracks["snapshot_id"] != snapshot_id:
+        return None
+    return cached_tracks
+
+
+def get_playlist_snapshot(user_session, playlist_id, headers):
+    """
+    Retrieves the current snapshot ID of a playlist, which changes whenever songs are added to or removed from it,
+    and records it as the playlist's latest known snapshot. Only the snapshot ID is requested, and it is revalidated
+    with a conditional request, so the check is cheap compared to paging through the tracks.
+
+    Args:
+        user_session (dict): The session of the user.
+        playlist_id (str): The ID of the playlist.
+        headers (dict): The headers sent with the request.
+
+    Returns:
+        tuple: The snapshot ID and None on success, or None and the failed response.
+    """
+    response = spotify_client.run(spotify_client.get(PLAYLIST_URL.format(playlist_id=playlist_id),
+                                                     user_session["response_cache"], headers=headers,
+                                                     params={"fields": "snapshot_id"}))
+    if response.status_code != 200:
+        return None, response
+    snapshot_id = response.json().get("snapshot_id")
+    user_session["playlist_snapshots"][playlist_id] = snapshot_id
+    return snapshot_id, None
+
+
+def parse_added_at(added_at):
+    """
+    Converts the time a track was added to a playlist into a timestamp.
+
+    Args:
+        added_at (str): The time in ISO 8601 format, as returned by Spotify, or None for very old playlists.
+
+    Returns:
+        float: The timestamp, or 0 if the time is unknown.
+    """
+    if not added_at:
+        return 0
+    return datetime.strptime(added_at, "%Y-%m-%dT%H:%M:%SZ").replace(tzinfo=timezone.utc).timestamp()
+
+
+def cache_tracks(user_session, playlist_id, tracks, snapshot_id):
+    """
+    Stores the tracks of a playlist in the cache under the snapshot that was current when they started being fetched.
+    The tracks are not stored if a newer snapshot has become known in the meantime, since they may be out of date.
+    Only compact columns are kept: the track URIs, the first artist and the album of each track as integer codes,
+    and the time each track was added to the playlist.
+
+    Args:
+        user_session (dict): The session of the user whose cache is used.
+        playlist_id (str): The ID of the playlist.
+        tracks (list): The playlist track items returned by Spotify.
+        snapshot_id (str): The snapshot ID of the playlist captured before its tracks were fetched.
+
+    Returns:
+        dict: The track columns of the playlist.
+    """
+    artist_codes_by_id = {}
+    album_codes_by_id = {}
+    playlist_tracks = {
+        "snapshot_id": snapshot_id,
+        "uris": [],
+        "artist_codes": array("l"),
+        "album_codes": array("l"),
+        "added_at": array("d"),
+        "alias_tables": {},
+        "queued_buckets": None
+    }
+    for track in tracks:
+        added_at = track.get("added_at")
+        track = track.get("track")
+        if not track:
+            continue
+        artists = track.get("artists") or [{}]
+        artist_id = artists[0].get("id")
+        album_id = (track.get("album") or {}).get("id")
+        playlist_tracks["uris"].append(track["uri"])
+        playlist_tracks["artist_codes"].append(artist_codes_by_id.setdefault(artist_id, len(artist_codes_by_id)))
+        playlist_tracks["album_codes"].append(album_codes_by_id.setdefault(album_id, len(album_codes_by_id)))
+        playlist_tracks["added_at"].append(parse_added_at(added_at))
+
+    if snapshot_id is not None and snapshot_id == user_session["playlist_snapshots"].get(playlist_id):
+        user_session["playlist_tracks_cache"][playlist_id] = playlist_tracks
+    return playlist_tracks
+
+
+def get_playlist_tracks(user_session, playlist_id, headers):
+    """
+    Retrieves the tracks of a playlist, using the cache when it matches the playlist's current snapshot and paging concurrently otherwise,
+    so that songs added or removed in another Spotify app are picked up by the next shuffle.
+    If the playlist is already being fetched for the user, such as by a prefetch, the result of that fetch is shared.
+
+    Args:
+        user_session (dict): The session of the user whose cache is used.
+        playlist_id (str): The ID of the playlist.
+        headers (dict): The headers sent with each request.
+
+    Returns:
+        tuple: The track columns of the playlist and None on success, or None and the failed response.
+    """
+    snapshot_id, failed_response = get_playlist_snapshot(user_session, playlist_id, headers)
+    if failed_response is not None:
+        return None, failed_response
+    playlist_tracks = get_cached_tracks(user_session, playlist_id)
+    if playlist_tracks is not None:
+        return playlist_tracks, None
+
+    def fetch_tracks():
+        tracks, failed_response = spotify_client.run(
+            spotify_client.get_all_pages(PLAYLIST_TRACKS_URL.format(playlist_id=playlist_id), headers,
+                                         PLAYLIST_TRACKS_PAGE_LIMIT))
+        if failed_response is not None:
+            return None, failed_response
+        return cache_tracks(user_session, playlist_id, tracks, snapshot_id), None
+
+    return single_flight(("playlist_tracks", headers["Authorization"], playlist_id, snapshot_id), fetch_tracks)
+
+
+def build_alias_table(weights):
+    """
+    Builds a Walker/Vose alias table, which allows picking an index in proportion to its weight in O(1) time.
+
+    Args:
+        weights (list): The weight of each index. Every weight must be positive.
+
+    Returns:
+        tuple: The probability array and the alias array of the table.
+    """
+    count = len(weights)
+    total_weight = sum(weights)
+    scaled_weights = [weight * count / total_weight for weight in weights]
+    probabilities = array("d", [1.0] * count)
+    aliases = array("l", range(count))
+    small = [index for index, weight in enumerate(scaled_weights) if weight < 1]
+    large = [index for index, weight in enumerate(scaled_weights) if weight >= 1]
+
+    while small and large:
+        small_index = small.pop()
+        large_index = large.pop()
+        probabilities[small_index] = scaled_weights[small_index]
+        aliases[small_index] = large_index
+        scaled_weights[large_index] -= 1 - scaled_weights[small_index]
+        if scaled_weights[large_index] < 1:
+            small.append(large_index)
+        else:
+            large.append(large_index)
+    return probabilities, aliases
+
+
+def sample_alias_table(alias_table):
+    """
+    Picks a random index from an alias table in O(1) time.
+
+    Args:
+        alias_table (tuple): The probability array and the alias array of the table.
+
+    Returns:
+        int: The picked index.
+    """
+    probabilities, aliases = alias_table
+    index = random.randrange(len(probabilities))
+    return index if random.random() < probabilities[index] else aliases[index]
+
+
+def get_alias_table(playlist_tracks):
+    """
+    Retrieves the "avoid_recent" alias table of a playlist, which down-weights tracks added to the playlist within the
+    last RECENTLY_ADDED_DAYS days. The table is stored with the cached tracks and is only rebuilt when the day changes,
+    while a new playlist snapshot replaces the cached tracks and their tables.
+
+    Args:
+        playlist_tracks (dict): The track columns of the playlist.
+
+    Returns:
+        tuple: The probability array and the alias array of the table.
+    """
+    today = int(time.time() // 86400)
+    cached_table = playlist_tracks["alias_tables"].get("avoid_recent")
+    if cached_table is None or cached_table["day"] != today:
+        weights = [max(MIN_TRACK_WEIGHT, min(1.0, (today - added_at // 86400) / RECENTLY_ADDED_DAYS))
+                   for added_at in playlist_tracks["added_at"]]
+        cached_table = {"day": today, "table": build_alias_table(weights)}
+        playlist_tracks["alias_tables"]["avoid_recent"] = cached_table
+    return cached_table["table"]
+
+
+def get_queued_buckets(user_session, playlist_tracks):
+    """
+    Retrieves the "rarely_queued" buckets of a playlist, building them on first use. Tracks are grouped into buckets
+    by how many times they have been queued, since every track queued k times has the same weight 1 / (1 + k).
+    Must be called with the session's queued counts lock held.
+
+    Args:
+        user_session (dict): The session of the user.
+        playlist_tracks (dict): The track columns of the playlist.
+
+    Returns:
+        dict: The queued count and bucket position of every track, the buckets of track indices keyed by queued count,
+        the track indices of every URI, and the alias table over the buckets, or None if it needs rebuilding.
+    """
+    if playlist_tracks["queued_buckets"] is None:
+        queued_counts = user_session["queued_counts"]
+        counts = array("l", [queued_counts.get(uri, 0) for uri in playlist_tracks["uris"]])
+        positions = array("l", [0] * len(counts))
+        buckets = {}
+        uri_indices = {}
+        for track_index, count in enumerate(counts):
+            bucket = buckets.setdefault(count, [])
+            positions[track_index] = len(bucket)
+            bucket.append(track_index)
+            uri_indices.setdefault(playlist_tracks["uris"][track_index], []).append(track_index)
+        playlist_tracks["queued_buckets"] = {"counts": counts, "positions": positions, "buckets": buckets,
+                                             "uri_indices": uri_indices, "table": None}
+    return playlist_tracks["queued_buckets"]
+
+
+def move_queued_track(queued_buckets, track_index):
+    """
+    Moves a track that has been queued once more into the next bucket in O(1) time,
+    by swapping it with the last track of its current bucket.
+
+    Args:
+        queued_buckets (dict): The "rarely_queued" buckets of the playlist.
+        track_index (int): The index of the queued track.
+    """
+    count = queued_buckets["counts"][track_index]
+    bucket = queued_buckets["buckets"][count]
+    last_track_index = bucket.pop()
+    if last_track_index != track_index:
+        position = queued_buckets["positions"][track_index]
+        bucket[position] = last_track_index
+        queued_buckets["positions"][last_track_index] = position
+    if not bucket:
+        del queued_buckets["buckets"][count]
+
+    next_bucket = queued_buckets["buckets"].setdefault(count + 1, [])
+    queued_buckets["counts"][track_index] = count + 1
+    queued_buckets["positions"][track_index] = len(next_bucket)
+    next_bucket.append(track_index)
+    queued_buckets["table"] = None
+
+
+def pick_weighted_tracks(user_session, playlist_tracks, weight, amount):
+    """
+    Picks random tracks from a playlist in proportion to their weight in a weighting mode.
+    "avoid_recent" uses an alias table over the tracks. "rarely_queued" down-weights tracks that have already been
+    added to the user's queue by this server, by picking a bucket from a small alias table over the queued count buckets,
+    weighted by the bucket's size times 1 / (1 + k), and then a track uniformly within it.
+
+    Args:
+        user_session (dict): The session of the user.
+        playlist_tracks (dict): The track columns of the playlist.
+        weight (str): The weighting mode, either "avoid_recent" or "rarely_queued".
+        amount (int): The number of tracks to pick.
+
+    Returns:
+        list: The indices of the picked tracks.
+    """
+    if weight == "avoid_recent":
+        alias_table = get_alias_table(playlist_tracks)
+        return [sample_alias_table(alias_table) for _ in range(amount)]
+
+    with user_session["queued_counts_lock"]:
+        queued_buckets = get_queued_buckets(user_session, playlist_tracks)
+        if queued_buckets["table"] is None:
+            counts = list(queued_buckets["buckets"])
+            queued_buckets["table"] = (counts, build_alias_table(
+                [len(queued_buckets["buckets"][count]) / (1 + count) for count in counts]))
+        counts, alias_table = queued_buckets["table"]
+        return [random.choice(queued_buckets["buckets"][counts[sample_alias_table(alias_table)]])
+                for _ in range(amount)]
+
+
+def record_queued_tracks(user_session, uris):
+    """
+    Counts the tracks added to the user's queue, which are used by the "rarely_queued" weighting mode.
+    Each cached playlist containing one of the tracks has it moved into the next queued count bucket.
+
+    Args:
+        user_session (dict): The session of the user.
+        uris (list): The URIs of the tracks added to the queue.
+    """
+    with user_session["queued_counts_lock"]:
+        for uri in uris:
+            user_session["queued_counts"][uri] = user_session["queued_counts"].get(uri, 0) + 1
+        for playlist_tracks in list(user_session["playlist_tracks_cache"].values()):
+            queued_buckets = playlist_tracks["queued_buckets"]
+            if queued_buckets is None:
+                continue
+            for uri in uris:
+                for track_index in queued_buckets["uri_indices"].get(uri, ()):
+                    move_queued_track(queued_buckets, track_index)
+
+
+def spread_tracks(track_indices, group_codes):
+    """
+    Orders tracks so that tracks from the same group, such as the same artist or album, are spread evenly across the sequence.
+    Each group's tracks are placed at even intervals starting from a random offset, with a small random jitter,
+    and all tracks are then sorted by position, which takes O(n log n) time.
+
+    Args:
+        track_indices (list): The indices of the picked tracks.
+        group_codes (array.array): The group code of every track in the playlist.
+
+    Returns:
+        list: The track indices in their spread order.
+    """
+    groups = {}
+    for track_index in track_indices:
+        groups.setdefault(group_codes[track_index], []).append(track_index)
+
+    positions = []
+    for group in groups.values():
+        random.shuffle(group)
+        spacing = 1 / len(group)
+        offset = random.random() * spacing
+        for i, track_index in enumerate(group):
+            jitter = random.uniform(-0.1, 0.1) * spacing
+            positions.append((offset + i * spacing + jitter, track_index))
+    positions.sort()
+    return [track_index for _, track_index in positions]
+
+
+@app.route('/warm_playlists', methods=["POST"])
+@user_session_required(budget="prefetches")
+def warm_playlists():
+    """
+    Fetches the tracks of every listed playlist that is not already cached, all at once.
+    Each playlist fetched is taken from the user's "prefetches" budget, so warming cannot use up the budget of the user's
+    other requests, and playlists beyond the budget are skipped.
+
+    Returns:
+        flask.Response: A JSON response containing the number of playlists warmed, failed and skipped.
+    """
+    access_token = get_valid_token(g.user_session)
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    snapshot_ids = dict(g.user_session["playlist_snapshots"])
+    uncached_playlist_ids = [playlist_id for playlist_id in snapshot_ids
+                             if get_cached_tracks(g.user_session, playlist_id) is None]
+    requests_by_playlist = {}
+    for playlist_id in uncached_playlist_ids:
+        if not consume_rate_limit(g.user_session, budget="prefetches"):
+            break
+        requests_by_playlist[playlist_id] = (PLAYLIST_TRACKS_URL.format(playlist_id=playlist_id), headers)
+    results = spotify_client.run(spotify_client.get_many_pages(requests_by_playlist, PLAYLIST_TRACKS_PAGE_LIMIT))
+
+    failed = 0
+    for playlist_id, (tracks, failed_response) in results.items():
+        if failed_response is None:
+            cache_tracks(g.user_session, playlist_id, tracks, snapshot_ids[playlist_id])
+        else:
+            failed += 1
+    return jsonify({"warmed": len(results) - failed, "failed": failed,
+                    "skipped": len(uncached_playlist_ids) - len(results)})
+
+
+@app.route('/prefetch_playlist/<playlist_id>', methods=["POST"])
+@user_session_required(budget="prefetches")
+def prefetch_playlist(playlist_id):
+    """
+    Fetches the tracks of a playlist into the cache ahead of a shuffle, such as when the playlist is selected.
+    Prefetches are taken from their own rate limit budget rather than the budget of the user's other requests.
+
+    Args:
+        playlist_id (str): The ID of the playlist to prefetch.
+
+    Returns:
+        flask.Response: A JSON response containing the number of tracks in the playlist, or an error message.
+    """
+    access_token = get_valid_token(g.user_session)
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    playlist_tracks, failed_response = get_playlist_tracks(g.user_session, playlist_id, headers)
+
+    if failed_response is not None:
+        return f"Failed to fetch playlist tracks.", failed_response.status_code
+    return jsonify({"tracks": len(playlist_tracks["uris"])})
+
+
 @app.route('/add_random_song_to_queue/<playlist_id>', methods=["POST"])
+@user_session_required
 def add_random_song_to_queue(playlist_id):
     """
     Adds a random song from the specified playlist to the playback queue.
@@ -287,44 +1046,85 @@ def add_random_song_to_queue(playlist_id):
     Returns:
         flask.Response: A message inicating the result of dthe operation.
     """
-    access_token = get_valid_token()
+    access_token = get_valid_token(g.user_session)
 
     headers = {"Authorization": f"Bearer {access_token}"}
-    limit = 100
-    offset = 0
-    all_tracks = []
-
-    while True:
-        response = requests.get(PLAYLIST_TRACKS_URL.format(playlist_id=playlist_id), headers=headers,
-                                                           params={"limit": limit, "offset": offset})
-
-        if response.status_code == 200:
-            tracks = response.json().get("items", [])
-            if not tracks:
-                break
-            all_tracks.extend(tracks)
-            if len(tracks) < limit:
-                break
-            offset += limit
-        else:
-            return f"Failed to fetch playlist tracks.", response.status_code
+    playlist_tracks, failed_response = get_playlist_tracks(g.user_session, playlist_id, headers)
 
-    if not all_tracks:
+    if failed_response is not None:
+        return f"Failed to fetch playlist tracks.", failed_response.status_code
+
+    if not playlist_tracks["uris"]:
         return jsonify({"error": "No tracks found in the playlist."})
 
-    random.shuffle(all_tracks)
-    random_track = random.choice(all_tracks)
-    song_uri = random_track["track"]["uri"]
+    song_uri = random.choice(playlist_tracks["uris"])
 
-    response = requests.post(QUEUE_URL, headers=headers, params={"uri": song_uri})
+    response = requests.post(QUEUE_URL, headers=headers, params={"uri": song_uri}, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 204:
+        record_queued_tracks(g.user_session, [song_uri])
         return "Random song added to queue successfully!"
     else:
         return "Failed to add song to queue.", response.status_code
 
 
+@app.route('/add_random_songs_to_queue/<playlist_id>', methods=["POST"])
+@user_session_required
+def add_random_songs_to_queue(playlist_id):
+    """
+    Adds several random songs from the specified playlist to the playback queue, inserting them concurrently.
+    If the "weight" query parameter is "avoid_recent" or "rarely_queued", songs are picked in proportion to their weight.
+    If the "spread" query parameter is "artist" or "album", songs by the same artist or from the same album are
+    spread evenly across the queue and inserted in that order.
+
+    Args:
+        playlist_id (str): The ID of the playlist from which the random songs will be added.
+
+    Returns:
+        flask.Response: A message indicating the result of the operation.
+    """
+    amount = request.args.get("amount", default=1, type=int)
+    if not 1 <= amount <= RATE_LIMIT_CAPACITY:
+        return f"The amount of songs must be between 1 and {RATE_LIMIT_CAPACITY}.", 400
+    spread = request.args.get("spread")
+    if spread not in (None, "artist", "album"):
+        return "Invalid spread mode.", 400
+    weight = request.args.get("weight")
+    if weight not in (None, "avoid_recent", "rarely_queued"):
+        return "Invalid weight mode.", 400
+    # The first insert was already taken from the budget by user_session_required
+    if amount > 1 and not consume_rate_limit(g.user_session, amount - 1):
+        return "Rate limit exceeded, try again later.", 429
+    access_token = get_valid_token(g.user_session)
+
+    headers = {"Authorization": f"Bearer {access_token}"}
+    playlist_tracks, failed_response = get_playlist_tracks(g.user_session, playlist_id, headers)
+
+    if failed_response is not None:
+        return f"Failed to fetch playlist tracks.", failed_response.status_code
+
+    if not playlist_tracks["uris"]:
+        return jsonify({"error": "No tracks found in the playlist."})
+
+    if weight is None:
+        track_indices = [random.randrange(len(playlist_tracks["uris"])) for _ in range(amount)]
+    else:
+        track_indices = pick_weighted_tracks(g.user_session, playlist_tracks, weight, amount)
+    if spread is not None:
+        track_indices = spread_tracks(track_indices, playlist_tracks[f"{spread}_codes"])
+    params_list = [{"uri": playlist_tracks["uris"][track_index]} for track_index in track_indices]
+    responses = spotify_client.run(spotify_client.post_many(QUEUE_URL, headers, params_list, ordered=spread is not None))
+
+    record_queued_tracks(g.user_session, [params["uri"] for params, response in zip(params_list, responses)
+                                          if response.status_code == 204])
+    for response in responses:
+        if response.status_code != 204:
+            return "Failed to add songs to queue.", response.status_code
+    return "Random songs added to queue successfully!"
+
+
 @app.route('/skip_to_next_song', methods=["POST"])
+@user_session_required
 def skip_to_next_song():
     """
     Skips to the next song in the playback.
@@ -332,10 +1132,10 @@ def skip_to_next_song():
     Returns:
         flask.Response: A message indicating the result of the operation.
     """
-    access_token = get_valid_token()
+    access_token = get_valid_token(g.user_session)
 
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.post(SKIP_SONG_URL, headers=headers)
+    response = requests.post(SKIP_SONG_URL, headers=headers, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 204:
         return "Skipped to next song successfully!"
@@ -344,6 +1144,7 @@ def skip_to_next_song():
 
 
 @app.route('/pause_playback', methods=["PUT"])
+@user_session_required
 def pause_playback():
     """
     Pauses the current playback.
@@ -351,10 +1152,10 @@ def pause_playback():
     Returns:
         flask.Response: A message indicating the result of the operation.
     """
-    access_token = get_valid_token()
+    access_token = get_valid_token(g.user_session)
 
     headers = {"Authorization": f"Bearer {access_token}"}
-    response = requests.put(PAUSE_PLAYBACK_URL, headers=headers)
+    response = requests.put(PAUSE_PLAYBACK_URL, headers=headers, timeout=REQUEST_TIMEOUT)
 
     if response.status_code == 204:
         return "Paused song successfully!"
@@ -0,0 +1,103 @@
+"""
+PooledWSGIServer Module
+
+This module provides a multi-threaded WSGI server that handles requests on a fixed pool of worker threads,
+with a bounded request queue, a read timeout for slow clients and a graceful drain of in-flight requests on shutdown.
+"""
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from werkzeug.serving import BaseWSGIServer, WSGIRequestHandler
+
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    A class that serves a WSGI application with a fixed number of worker threads.
+    """
+    multithread = True
+
+    def __init__(self, host, port, app, workers=8, request_queue_size=64, read_timeout=5):
+        """
+        Initializes the PooledWSGIServer instance and starts listening on the given host and port.
+
+        Args:
+            host (str): The host to listen on.
+            port (int): The port to listen on.
+            app (flask.Flask): The WSGI application to serve.
+            workers (int): The number of worker threads handling requests.
+            request_queue_size (int): The number of accepted connections that can wait for a free worker,
+                also used as the listen backlog of the socket.
+            read_timeout (int): The number of seconds to wait for a client to send its request before the connection is closed.
+                Connections are not kept alive, since werkzeug's request handler closes every connection after one response.
+        """
+        self.request_queue_size = request_queue_size
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="wsgi-worker")
+        self.request_slots = threading.BoundedSemaphore(workers + request_queue_size)
+        self.pending_requests = {}
+        self.pending_requests_lock = threading.Lock()
+        self.shutting_down = threading.Event()
+        handler = type("PooledRequestHandler", (WSGIRequestHandler,), {"timeout": read_timeout})
+        super().__init__(host, port, app, handler=handler)
+
+    def process_request(self, request, client_address):
+        """
+        Hands an accepted connection to the worker pool. Blocks the accept loop while the request queue is full,
+        so further connections wait in the socket's listen backlog. If the server starts shutting down while waiting,
+        the connection is closed instead.
+
+        Args:
+            request (socket.socket): The accepted connection.
+            client_address (tuple): The address of the client.
+        """
+        while not self.request_slots.acquire(timeout=0.1):
+            if self.shutting_down.is_set():
+                self.shutdown_request(request)
+                return
+        future = self.executor.submit(self.process_request_worker, request, client_address)
+        with self.pending_requests_lock:
+            self.pending_requests[future] = request
+        future.add_done_callback(self.finish_pending_request)
+
+    def process_request_worker(self, request, client_address):
+        """
+        Handles a connection on a worker thread and closes it afterwards.
+
+        Args:
+            request (socket.socket): The accepted connection.
+            client_address (tuple): The address of the client.
+        """
+        try:
+            self.finish_request(request, client_address)
+        except Exception:
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+
+    def finish_pending_request(self, future):
+        """
+        Frees the request queue slot of a finished connection. Connections that were cancelled before a worker
+        picked them up are closed here, since their worker never ran.
+
+        Args:
+            future (concurrent.futures.Future): The future of the finished connection.
+        """
+        with self.pending_requests_lock:
+            request = self.pending_requests.pop(future, None)
+        if future.cancelled() and request is not None:
+            self.shutdown_request(request)
+        self.request_slots.release()
+
+    def shutdown_gracefully(self, drain_timeout=10):
+        """
+        Stops accepting connections, waits for in-flight requests to finish and closes the server.
+        Requests still waiting for a worker after the drain timeout are cancelled and their connections closed.
+
+        Args:
+            drain_timeout (int): The maximum number of seconds to wait for in-flight requests.
+        """
+        self.shutting_down.set()
+        self.shutdown()
+        with self.pending_requests_lock:
+            pending_requests = list(self.pending_requests)
+        wait(pending_requests, timeout=drain_timeout)
+        self.executor.shutdown(wait=False, cancel_futures=True)
+        self.server_close()
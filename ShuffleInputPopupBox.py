@@ -9,8 +9,12 @@ from tkinter import ttk, messagebox
 
 class ShuffleInputPopupBox:
     """
-    A class to create a popup window for user input regarding the number of songs to shuffle from a playlist.
+    A class to create a popup window for user input regarding the number of songs to shuffle from a playlist,
+    whether songs by the same artist or from the same album should be spread apart, and how songs should be weighted.
     """
+    spread_modes = {"No spread": None, "Spread artists": "artist", "Spread albums": "album"}
+    weight_modes = {"No weighting": None, "Favor older songs": "avoid_recent", "Favor rarely shuffled": "rarely_queued"}
+
     def __init__(self, root, receive_input_popupbox):
         """
         Initialize the ShuffleInputPopupBox.
@@ -29,13 +33,13 @@ class ShuffleInputPopupBox:
         self.window.option_add("*tearOff", False)
         self.window.title("# of songs")
         self.window.iconbitmap("assets/icon.ico")
-        self.window.geometry("275x150")
+        self.window.geometry("275x225")
         self.window.resizable(None,None)
         self.window.configure(background=dark_gray_color)
         self.window.focus_set()
 
         window_width = 275
-        window_height = 150
+        window_height = 225
         screen_width = self.window.winfo_screenwidth()
         screen_height = self.window.winfo_screenheight()
         window_position_x = (screen_width // 2) - (window_width // 2)
@@ -53,6 +57,14 @@ class ShuffleInputPopupBox:
         self.song_shuffle_entry = ttk.Entry(self.window, width=15)
         self.song_shuffle_entry.pack(pady=10)
 
+        self.spread_mode_combobox = ttk.Combobox(self.window, values=list(self.spread_modes), state="readonly", width=13)
+        self.spread_mode_combobox.current(0)
+        self.spread_mode_combobox.pack()
+
+        self.weight_mode_combobox = ttk.Combobox(self.window, values=list(self.weight_modes), state="readonly", width=18)
+        self.weight_mode_combobox.current(0)
+        self.weight_mode_combobox.pack(pady=(5, 0))
+
         ok_button = ttk.Button(self.window, text="Ok", style="Accent.TButton", command=self.get_input_popupbox, width=15)
         ok_button.pack(pady=10)
 
@@ -148,7 +160,7 @@ class ShuffleInputPopupBox:
 
     def get_input_popupbox(self):
         """
-        Get the user's input from the popup box, validate it, and pass it to the callback function.
+        Get the user's input from the popup box, validate it, and pass it with the selected spread and weight modes to the callback function.
         """
         try:
             get_song_shuffle_amount = int(self.song_shuffle_entry.get())
@@ -162,7 +174,9 @@ class ShuffleInputPopupBox:
                 messagebox.showerror("Invalid Input", "Please enter a number less than 25 into the text box.")
                 self.window.focus_force()
             else:
-                self.receive_input_popupbox(get_song_shuffle_amount)
+                self.receive_input_popupbox(get_song_shuffle_amount,
+                                            self.spread_modes[self.spread_mode_combobox.get()],
+                                            self.weight_modes[self.weight_mode_combobox.get()])
                 print(get_song_shuffle_amount)
                 self.window.destroy()
         except ValueError:
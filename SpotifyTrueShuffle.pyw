@@ -11,18 +11,28 @@ import webbrowser
 import io
 import queue
 import threading
-import concurrent
 from concurrent.futures import ThreadPoolExecutor
-from FlaskServer import run_flask, update_api_credentials, clear_user_token
+from FlaskServer import (run_flask, stop_flask, update_api_credentials, clear_user_token, spotify_client,
+                         SESSION_HEADER, SERVER_PUBLIC_URL)
 from AuthenticateWindow import AuthenticateWindow
 from ShuffleInputPopupBox import ShuffleInputPopupBox
 from ApiCredentialsWindow import ApiCredentialsWindow
 
 
-FLASK_SERVER_URL = "http://127.0.0.1:5000"
+FLASK_SERVER_URL = SERVER_PUBLIC_URL
+session_id = None
+flask_session = requests.Session()
 playlists = []
 image_queue = queue.Queue()
+image_response_cache = {}
 song_shuffle_amount = 0
+song_spread_mode = None
+song_weight_mode = None
+PREFETCH_DELAY_MS = 400
+prefetch_executor = ThreadPoolExecutor(max_workers=2)
+prefetch_futures = {}
+prefetch_sessions = threading.local()
+prefetch_after_id = None
 shuffling_active = False
 currently_shuffling_playlist = None
 
@@ -37,6 +47,15 @@ def start_flask_server():
     api_credentials_popupbox()
 
 
+def close_application():
+    """
+    Stops the Flask server gracefully and closes the main window.
+    """
+    prefetch_executor.shutdown(wait=False, cancel_futures=True)
+    stop_flask()
+    root.destroy()
+
+
 def authenticate(authenticate_window):
     """
     Opens the Spotify authentication URL and checks the authentication status.
@@ -44,7 +63,19 @@ def authenticate(authenticate_window):
      Args:
         authenticate_window (AuthenticateWindow): The window object that handles the authentication process.
     """
-    webbrowser.open(f"{FLASK_SERVER_URL}/")
+    global session_id
+    try:
+        if session_id is None:
+            session_response = flask_session.post(f"{FLASK_SERVER_URL}/create_session")
+            session_response.raise_for_status()
+            session_id = session_response.json()["session_id"]
+            flask_session.headers[SESSION_HEADER] = session_id
+        login_response = flask_session.post(f"{FLASK_SERVER_URL}/start_login")
+        login_response.raise_for_status()
+    except requests.exceptions.RequestException as e:
+        messagebox.showerror("Authentication Error", f"Failed to start authentication, please check to make sure that flask server is running properly: {e}")
+        return
+    webbrowser.open(login_response.json()["login_url"])
     root.after(3000, lambda: check_authentication(authenticate_window))
 
 
@@ -63,7 +94,7 @@ def check_authentication(authenticate_window):
         authenticate_window (AuthenticateWindow): The window object that handles the authentication process.
     """
     try:
-        response = requests.get(f"{FLASK_SERVER_URL}/check_authentication")
+        response = flask_session.get(f"{FLASK_SERVER_URL}/check_authentication")
         auth_data = response.json()
         if response.status_code == 200 and auth_data.get("success"):
             root.deiconify()
@@ -77,6 +108,17 @@ def check_authentication(authenticate_window):
         messagebox.showerror("Authentication Error", f"Failed to check authentication, please check to make sure that flask server is running properly: {e}")
 
 
+def clear_session():
+    """
+    Clears the stored tokens of this application's session on the Flask server, so that a new session is created on the next login.
+    """
+    global session_id
+    if session_id is not None:
+        clear_user_token(session_id)
+        session_id = None
+        flask_session.headers.pop(SESSION_HEADER, None)
+
+
 def receive_api_credentials(client_id, client_secret, destroy_api_credentials_window):
     """
     Receives and updates the API credentials, then initiates the authentication process.
@@ -86,8 +128,7 @@ def receive_api_credentials(client_id, client_secret, destroy_api_credentials_wi
         client_secret (str): The Spotify API client secret.
         destroy_api_credentials_window (function): The function to close the API credentials window.
     """
-    clear_user_token()
-    clear_user_token()
+    clear_session()
     destroy_api_credentials_window()
     update_api_credentials(client_id, client_secret)
     authenticate_popupbox()
@@ -100,29 +141,38 @@ def api_credentials_popupbox():
     ApiCredentialsWindow(root, receive_api_credentials)
 
 
-def fetch_playlist_images(playlist):
+def fetch_playlist_images(playlists):
     """
-    Fetches the cover images of playlists and resizes them for display.
+    Fetches the cover images of playlists concurrently and resizes them for display.
+    Images that were downloaded before are revalidated and reused if they have not changed, and cached images whose URL
+    is no longer used by any playlist, such as old mosaic covers of playlists that have changed, are dropped.
 
     Args:
-        playlist (dict): A dictionary containing playlist details, including the image URL.
+        playlists (list): A list of dictionaries containing playlist details, including the image URL.
     """
-    try:
-        if playlist["images"]:
-            image_url = playlist["images"][0]["url"]
-            image_response = requests.get(image_url)
-            image_data = image_response.content
-            image = Image.open(io.BytesIO(image_data))
-            image.thumbnail((100, 100))
-            image_queue.put((playlist["id"], image))
-        else:
+    image_urls = {playlist["id"]: playlist["images"][0]["url"] for playlist in playlists if playlist["images"]}
+    image_contents = spotify_client.run(spotify_client.get_many_contents(image_urls, image_response_cache))
+    current_image_urls = set(image_urls.values())
+    for cache_key in [cache_key for cache_key in image_response_cache if cache_key[0] not in current_image_urls]:
+        del image_response_cache[cache_key]
+
+    for playlist in playlists:
+        try:
+            image_data = image_contents.get(playlist["id"])
+            if isinstance(image_data, Exception):
+                raise image_data
+            if image_data:
+                image = Image.open(io.BytesIO(image_data))
+                image.thumbnail((100, 100))
+                image_queue.put((playlist["id"], image))
+            else:
+                image_queue.put((playlist["id"], None))
+        except requests.exceptions.RequestException as e:
+            print(f"Request error: {e}")
+            image_queue.put((playlist["id"], None))
+        except Exception as e:
+            print(f"Error processing image for playlist {playlist['id']}: {e}")
             image_queue.put((playlist["id"], None))
-    except requests.exceptions.RequestException as e:
-        print(f"Request error: {e}")
-        image_queue.put((playlist["id"], None))
-    except Exception as e:
-        print(f"Error processing image for playlist {playlist['id']}: {e}")
-        image_queue.put((playlist["id"], None))
 
 
 def get_playlists():
@@ -131,7 +181,7 @@ def get_playlists():
     """
     global playlists
     try:
-        response = requests.get(f"{FLASK_SERVER_URL}/playlists")
+        response = flask_session.get(f"{FLASK_SERVER_URL}/playlists")
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         messagebox.showerror("Request Error", f"Failed to fetch playlists, Try again!: {e}")
@@ -145,16 +195,12 @@ def get_playlists():
     for i in tree.get_children():
         tree.delete(i)
 
-    with concurrent.futures.ThreadPoolExecutor() as executor:
-        futures = []
-        for playlist in playlists:
-            tree.insert("", "end", iid=playlist["id"], text="            " + playlist["name"])
-            futures.append(executor.submit(fetch_playlist_images, playlist))
-        for future in concurrent.futures.as_completed(futures):
-            try:
-                future.result()
-            except Exception as e:
-                messagebox.showerror("Image Fetch Error", f"Failed to fetch playlist images: {e}")
+    for playlist in playlists:
+        tree.insert("", "end", iid=playlist["id"], text="            " + playlist["name"])
+    try:
+        fetch_playlist_images(playlists)
+    except Exception as e:
+        messagebox.showerror("Image Fetch Error", f"Failed to fetch playlist images: {e}")
     root.after(100, update_treeview)
 
 
@@ -187,6 +233,61 @@ def update_treeview():
         pass
 
 
+def request_playlist_prefetch(playlist_id, prefetch_session_id):
+    """
+    Asks the Flask server to fetch the tracks of a playlist into its cache. Runs on a prefetch worker thread,
+    which uses its own requests session since sessions are not thread-safe. Failures are ignored,
+    since the tracks are fetched again when the playlist is shuffled.
+
+    Args:
+        playlist_id (str): The ID of the playlist to prefetch.
+        prefetch_session_id (str): The session ID of this application on the Flask server.
+    """
+    if not hasattr(prefetch_sessions, "session"):
+        prefetch_sessions.session = requests.Session()
+    try:
+        prefetch_sessions.session.post(f"{FLASK_SERVER_URL}/prefetch_playlist/{playlist_id}",
+                                       headers={SESSION_HEADER: prefetch_session_id})
+    except requests.exceptions.RequestException as e:
+        print(f"Prefetch error: {e}")
+
+
+def prefetch_playlist(event):
+    """
+    Schedules a prefetch of the selected playlist's tracks once the selection has stopped changing for PREFETCH_DELAY_MS,
+    so that moving through the list with the arrow keys does not prefetch every playlist passed over.
+
+    Args:
+        event (tk.Event): The Treeview selection event.
+    """
+    global prefetch_after_id
+    if prefetch_after_id is not None:
+        root.after_cancel(prefetch_after_id)
+    prefetch_after_id = root.after(PREFETCH_DELAY_MS, start_playlist_prefetch)
+
+
+def start_playlist_prefetch():
+    """
+    Starts prefetching the tracks of the selected playlist in the background so that shuffling it does not wait for them.
+    Prefetches of other playlists that are still waiting for a worker are cancelled, while prefetches that have already
+    been sent to the Flask server run to completion. A playlist already being prefetched is not requested again.
+    """
+    global prefetch_after_id
+    prefetch_after_id = None
+    selected_item = tree.selection()
+    if not selected_item or session_id is None:
+        return
+    playlist_id = selected_item[0]
+    for other_playlist_id, future in list(prefetch_futures.items()):
+        if other_playlist_id != playlist_id:
+            future.cancel()
+    if playlist_id in prefetch_futures:
+        return
+    future = prefetch_executor.submit(request_playlist_prefetch, playlist_id, session_id)
+    prefetch_futures[playlist_id] = future
+    future.add_done_callback(lambda done_future: prefetch_futures.pop(playlist_id, None))
+
+
 def shuffle_playlist():
     """
     Shuffles songs in the selected playlist by adding random songs to the queue.
@@ -202,13 +303,17 @@ def shuffle_playlist():
         return
     playlist_id = selected_item[0]
     currently_shuffling_playlist = playlist_id
-    for i in range(song_shuffle_amount):
-        try:
-            shuffle_playlist_response = requests.post(f"{FLASK_SERVER_URL}/add_random_song_to_queue/{playlist_id}")
-            shuffle_playlist_response.raise_for_status()
-        except requests.exceptions.RequestException:
-            messagebox.showerror("Shuffle Error", f"Failed to shuffle playlist, try unpausing and pausing a song on spotify then try again!")
+    try:
+        shuffle_playlist_response = flask_session.post(f"{FLASK_SERVER_URL}/add_random_songs_to_queue/{playlist_id}",
+                                                       params={"amount": song_shuffle_amount, "spread": song_spread_mode,
+                                                               "weight": song_weight_mode})
+        if shuffle_playlist_response.status_code == 429:
+            messagebox.showerror("Shuffle Error", "Too many requests were made in a short time, wait a minute then try again!")
             return
+        shuffle_playlist_response.raise_for_status()
+    except requests.exceptions.RequestException:
+        messagebox.showerror("Shuffle Error", f"Failed to shuffle playlist, try unpausing and pausing a song on spotify then try again!")
+        return
     if not shuffling_active:
         for item in tree.get_children():
             if item == currently_shuffling_playlist:
@@ -222,21 +327,27 @@ def skip_to_next_song(): #REMOVED TRUE AND FALSE RETURN STATMENTS
     Skips to the next song in the Spotify queue.
     """
     try:
-        response = requests.post(f"{FLASK_SERVER_URL}/skip_to_next_song")
+        response = flask_session.post(f"{FLASK_SERVER_URL}/skip_to_next_song")
         response.raise_for_status()
     except requests.exceptions.RequestException as e:
         messagebox.showerror("Error", f"Failed to skip to next song: {e}")
 
 
-def receive_input_popupbox(get_song_shuffle_amount):
+def receive_input_popupbox(get_song_shuffle_amount, get_song_spread_mode, get_song_weight_mode):
     """
-    Receives the number of songs to shuffle and starts the shuffle process.
+    Receives the number of songs to shuffle with the spread and weight modes, then starts the shuffle process.
 
     Args:
         get_song_shuffle_amount (int): The number of songs to be shuffled.
+        get_song_spread_mode (str): "artist" or "album" to spread songs by the same artist or album apart, or None.
+        get_song_weight_mode (str): "avoid_recent" or "rarely_queued" to weight the songs picked, or None.
     """
     global song_shuffle_amount
+    global song_spread_mode
+    global song_weight_mode
     song_shuffle_amount = get_song_shuffle_amount
+    song_spread_mode = get_song_spread_mode
+    song_weight_mode = get_song_weight_mode
     shuffle_playlist()
 
 
@@ -294,6 +405,7 @@ tree.column("Shuffling", width=170, stretch=tk.NO)
 tree_scroll = ttk.Scrollbar(tree_frame, orient=tk.VERTICAL, command=tree.yview)
 tree_scroll.pack(side=tk.RIGHT, fill=tk.Y)
 tree.configure(yscrollcommand=tree_scroll.set)
+tree.bind("<<TreeviewSelect>>", prefetch_playlist)
 
 # Initialize the images attribute to avoid garbage collection
 tree.images = {}
@@ -311,5 +423,7 @@ refresh_playlists_button = ttk.Button(root, text=" Refresh Playlists ", style="A
 refresh_playlists_button.place(x=385 ,y=65)
 
 
+root.protocol("WM_DELETE_WINDOW", close_application)
+
 start_flask_server()
 root.mainloop()
\ No newline at end of file